@@ -30,8 +30,15 @@ class Settings(BaseSettings):
     APP_HOST: str = "0.0.0.0"
     APP_PORT: int = 8000
     DEBUG: bool = True
+    MAX_REQUEST_BODY_SIZE: int = 10 * 1024 * 1024  # 请求体大小上限（字节），超过返回413
+    STREAM_INCLUDE_USAGE: bool = True  # 流式请求向deepseek/openai请求usage以统计前缀缓存命中，上游不支持时关闭
     
-
+    # 语义缓存配置（需要安装 numpy 和 sentence-transformers）
+    SEMANTIC_CACHE_ENABLED: bool = False
+    SEMANTIC_CACHE_MODEL: str = "paraphrase-multilingual-MiniLM-L12-v2"
+    SEMANTIC_CACHE_THRESHOLD: float = 0.92
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 1000
+    SEMANTIC_CACHE_TTL: int = 3600  # 秒
     
     class Config:
         env_file = ".env"
@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import inspect
 import json
 import httpx
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Callable, List, Optional
 import time
 import uuid
 from .config import get_settings
+from .semantic_cache import SemanticCache
+from .tool_call_assembler import ToolCallAssembler
+from .prompt_cache import (
+    STREAM_USAGE_PROVIDERS,
+    PromptCacheStats,
+    extract_cache_usage,
+)
 
 class DirectAgent:
     """直接透传的Agent"""
@@ -14,37 +23,181 @@ class DirectAgent:
     def __init__(self):
         settings = get_settings()
         self.model_config = settings.get_active_model_config()
+        self.stream_include_usage = settings.STREAM_INCLUDE_USAGE
         self.client = httpx.AsyncClient(timeout=120.0)
+        self.prompt_cache_stats = PromptCacheStats()
+        # 异步工具调用回调创建的任务，保留引用避免被回收
+        self.tool_call_tasks = set()
+        self.semantic_cache = None
+        if settings.SEMANTIC_CACHE_ENABLED:
+            try:
+                self.semantic_cache = SemanticCache(
+                    settings.SEMANTIC_CACHE_MODEL,
+                    threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+                    max_entries=settings.SEMANTIC_CACHE_MAX_ENTRIES,
+                    ttl=settings.SEMANTIC_CACHE_TTL,
+                )
+            except Exception as e:
+                print(f"⚠️  语义缓存初始化失败，已禁用: {e}")
         print(f"✅ DirectAgent初始化完成")
+    
+    async def _semantic_cache_key(self, messages: List[Dict], tools: Optional[List[Dict]], kwargs: Dict):
+        """计算语义缓存的 (作用域, 查询, 向量)，不可缓存时返回 None"""
+        if not self.semantic_cache:
+            return None
+        # 缓存只保存单个回答，n>1 时不走语义缓存
+        if kwargs.get("n", 1) != 1:
+            return None
+        query = SemanticCache.extract_query(messages)
+        if query is None:
+            return None
+        try:
+            scope = SemanticCache.build_scope(self.model_config["model"], messages, tools, kwargs)
+            vector = await self.semantic_cache.embed(query)
+        except Exception as e:
+            print(f"⚠️  语义缓存向量计算失败，按未命中处理: {e}")
+            return None
+        return scope, query, vector
+    
+    async def _semantic_cache_lookup(self, cache_key) -> Optional[str]:
+        """查询语义缓存，出错时按未命中处理"""
+        try:
+            return await self.semantic_cache.lookup(cache_key[0], cache_key[2])
+        except Exception as e:
+            print(f"⚠️  语义缓存查询失败，按未命中处理: {e}")
+            return None
+    
+    async def _semantic_cache_store(self, cache_key, content: str):
+        """写入语义缓存，出错时只记录日志"""
+        try:
+            await self.semantic_cache.store(cache_key[0], cache_key[1], cache_key[2], content)
+        except Exception as e:
+            print(f"⚠️  语义缓存写入失败: {e}")
+    
+    def _run_tool_call_callback(self, request_id: str, on_tool_call: Callable[[Dict], Any], tool_call: Dict):
+        """执行工具调用回调，协程回调作为后台任务运行，异常只记录日志不中断流"""
+        name = tool_call["function"]["name"]
+        try:
+            result = on_tool_call(tool_call)
+        except Exception as e:
+            print(f"❌ [{request_id}] 工具调用回调异常: {name} - {e}")
+            return
+        if not inspect.isawaitable(result):
+            return
         
-    async def stream_chat(self, messages: List[Dict], tools: Optional[List[Dict]] = None, **kwargs):
-        """流式聊天，直接透传给大模型"""
-        request_id = str(uuid.uuid4())[:8]
+        task = asyncio.ensure_future(result)
+        self.tool_call_tasks.add(task)
         
-        print(f"\n🔄 [{request_id}] 开始流式聊天请求")
-        print(f"📝 [{request_id}] 消息数量: {len(messages)}")
-        print(f"🔧 [{request_id}] 工具数量: {len(tools) if tools else 0}")
+        def on_done(done_task):
+            self.tool_call_tasks.discard(done_task)
+            if not done_task.cancelled() and done_task.exception():
+                print(f"❌ [{request_id}] 工具调用回调任务异常: {name} - {done_task.exception()}")
         
-        # 构建请求数据
-        request_data = {
-            "model": self.model_config["model"],
-            "messages": messages,
-            "stream": True,
-            "temperature": kwargs.get("temperature", 0.7),
-            "max_tokens": kwargs.get("max_tokens", 2000),
+        task.add_done_callback(on_done)
+    
+    def _should_inject_stream_usage(self, stream: bool, kwargs: Dict) -> bool:
+        """客户端未指定stream_options时，才由服务端为支持的提供商请求usage"""
+        return (
+            stream
+            and self.stream_include_usage
+            and "stream_options" not in kwargs
+            and self.model_config["provider"] in STREAM_USAGE_PROVIDERS
+        )
+    
+    def _build_request_data(self, request_id: str, messages: List[Dict], tools: Optional[List[Dict]],
+                            stream: bool, kwargs: Dict) -> Dict[str, Any]:
+        """构建上游请求数据，messages和tools按客户端原始内容和顺序透传"""
+        params = {
+            "temperature": 0.7,
+            "max_tokens": 2000,
+            "stream": stream,
         }
+        if self._should_inject_stream_usage(stream, kwargs):
+            # 流式响应的最后一个chunk携带usage，用于统计前缀缓存命中；该chunk不会转发给客户端
+            params["stream_options"] = {"include_usage": True}
         
         # 如果有tools，也透传
         if tools:
-            request_data["tools"] = tools
-            request_data["tool_choice"] = kwargs.get("tool_choice", "auto")
-            print(f"🔧 [{request_id}] 工具配置: {request_data['tool_choice']}")
+            params["tool_choice"] = kwargs.get("tool_choice", "auto")
+            print(f"🔧 [{request_id}] 工具配置: {params['tool_choice']}")
         
         # 添加其他参数
         for key, value in kwargs.items():
             if key not in ["temperature", "max_tokens", "tool_choice"]:
-                request_data[key] = value
                 print(f"⚙️  [{request_id}] 额外参数: {key}={value}")
+            if key != "tool_choice":
+                params[key] = value
+        
+        request_data = {
+            "model": params.pop("model", self.model_config["model"]),
+            "messages": messages,
+        }
+        if tools:
+            request_data["tools"] = tools
+            request_data["tool_choice"] = params.pop("tool_choice")
+        for key in sorted(params):
+            request_data[key] = params[key]
+        return request_data
+    
+    def _record_cache_usage(self, request_id: str, usage: Optional[Dict]):
+        """记录上游前缀缓存命中情况，统计出错时只记录日志"""
+        try:
+            cache_usage = extract_cache_usage(usage)
+            if cache_usage is None:
+                return
+            self.prompt_cache_stats.record(cache_usage)
+        except Exception as e:
+            print(f"⚠️  [{request_id}] 前缀缓存统计失败: {e}")
+            return
+        prompt_tokens = cache_usage["prompt_tokens"]
+        cached_tokens = cache_usage["cached_tokens"]
+        hit_rate = cached_tokens / prompt_tokens * 100 if prompt_tokens else 0.0
+        print(f"💾 [{request_id}] 前缀缓存命中: {cached_tokens}/{prompt_tokens} tokens ({hit_rate:.1f}%)")
+    
+    def _build_cached_completion(self, request_id: str, content: str, stream: bool) -> Dict[str, Any]:
+        """根据缓存内容构造OpenAI兼容的响应"""
+        if stream:
+            return {
+                "id": f"chatcmpl-cache-{request_id}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": self.model_config["model"],
+                "choices": [{
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": content},
+                    "finish_reason": "stop"
+                }]
+            }
+        return {
+            "id": f"chatcmpl-cache-{request_id}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.model_config["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }]
+        }
+        
+    async def stream_chat(self, messages: List[Dict], tools: Optional[List[Dict]] = None,
+                          on_tool_call: Optional[Callable[[Dict], Any]] = None,
+                          tool_call_events: bool = False, **kwargs):
+        """流式聊天，直接透传给大模型
+        
+        Args:
+            on_tool_call: 每个工具调用参数完整时立即回调，可在整轮响应结束前开始执行工具；
+                支持普通函数和 async 函数，async 回调会作为后台任务运行，回调异常只记录日志
+            tool_call_events: 为True时在流中额外输出 `event: tool_call` 的SSE事件
+        """
+        request_id = str(uuid.uuid4())[:8]
+        
+        print(f"\n🔄 [{request_id}] 开始流式聊天请求")
+        print(f"📝 [{request_id}] 消息数量: {len(messages)}")
+        print(f"🔧 [{request_id}] 工具数量: {len(tools) if tools else 0}")
+        
+        request_data = self._build_request_data(request_id, messages, tools, True, kwargs)
+        usage_injected = self._should_inject_stream_usage(True, kwargs)
         
         # 打印最后一条用户消息（用于调试）
         if messages:
@@ -57,6 +210,16 @@ class DirectAgent:
             "Authorization": f"Bearer {self.model_config['api_key']}",
         }
         
+        # 查询语义缓存
+        cache_key = await self._semantic_cache_key(messages, tools, kwargs)
+        if cache_key:
+            cached = await self._semantic_cache_lookup(cache_key)
+            if cached is not None:
+                print(f"🎯 [{request_id}] 语义缓存命中，跳过上游请求")
+                yield f"data: {json.dumps(self._build_cached_completion(request_id, cached, stream=True), ensure_ascii=False)}\n\n"
+                yield "data: [DONE]\n\n"
+                return
+        
         print(f"🌐 [{request_id}] 发送请求到: {self.model_config['base_url']}/chat/completions")
         print(f"📊 [{request_id}] 请求参数: model={request_data['model']}, stream={request_data['stream']}")
         
@@ -80,38 +243,80 @@ class DirectAgent:
                     print(f"❌ [{request_id}] 错误内容: {error_text.decode()}")
                     raise Exception(f"API请求失败: {response.status_code} - {error_text.decode()}")
                 
-                chunk_count = 0
+                line_count = 0
                 valid_chunk_count = 0
+                # 用于写入语义缓存的回答内容
+                content_parts = []
+                finish_reason = None
+                cache_stored = False
+                tool_call_assembler = ToolCallAssembler()
                 
-                async for raw_chunk in response.aiter_text():
-                    if raw_chunk.strip():
-                        chunk_count += 1
+                def completed_tool_call_events(completed_calls):
+                    """记录已完整的工具调用，回调并按需生成SSE事件"""
+                    events = []
+                    for tool_call in completed_calls:
+                        print(f"🔧 [{request_id}] 工具调用已完整: {tool_call['function']['name']} ({tool_call['id']})")
+                        if on_tool_call:
+                            self._run_tool_call_callback(request_id, on_tool_call, tool_call)
+                        if tool_call_events:
+                            events.append(f"event: tool_call\ndata: {json.dumps(tool_call, ensure_ascii=False)}\n\n")
+                    return events
+                
+                # 按行读取，避免SSE数据行被网络分块截断
+                async for line in response.aiter_lines():
+                    line = line.strip()
+                    if not line:
+                        continue
+                    line_count += 1
+                    if not line.startswith('data: '):
+                        continue
+                    data = line[6:].strip()
+                    
+                    if data == '[DONE]':
+                        for event in completed_tool_call_events(tool_call_assembler.finish()):
+                            yield event
+                        print(f"✅ [{request_id}] 流式响应完成，共处理 {line_count} 行，{valid_chunk_count} 个有效chunk")
+                        yield "data: [DONE]\n\n"
+                        return
+                    elif data:
+                        # 验证JSON格式
+                        try:
+                            chunk_data = json.loads(data)
+                        except json.JSONDecodeError:
+                            # 如果JSON格式错误，记录日志但不转发
+                            print(f"⚠️  [{request_id}] 跳过无效JSON数据 (第{line_count}行)")
+                            continue
+                        
+                        valid_chunk_count += 1
+                        if chunk_data.get("usage"):
+                            self._record_cache_usage(request_id, chunk_data["usage"])
+                            # 服务端自行请求的usage chunk不转发，保持流内容与客户端请求一致
+                            if usage_injected and not chunk_data.get("choices"):
+                                continue
+                        completed_calls = []
+                        for choice in chunk_data.get("choices") or []:
+                            delta = choice.get("delta") or {}
+                            if cache_key and choice.get("index", 0) == 0 and delta.get("content"):
+                                content_parts.append(delta["content"])
+                            if delta.get("tool_calls"):
+                                completed_calls.extend(tool_call_assembler.feed(delta["tool_calls"]))
+                            if choice.get("finish_reason"):
+                                if choice.get("index", 0) == 0:
+                                    finish_reason = choice["finish_reason"]
+                                completed_calls.extend(tool_call_assembler.finish())
+                        
+                        # 收到 finish_reason 就写入缓存：客户端可能读到结束chunk后立即断开，等不到 [DONE]
+                        if cache_key and finish_reason == "stop" and not cache_stored and not tool_call_assembler.has_tool_calls:
+                            cache_stored = True
+                            await self._semantic_cache_store(cache_key, "".join(content_parts))
                         
-                        # 处理每一行数据
-                        for line in raw_chunk.strip().split('\n'):
-                            line = line.strip()
-                            if line.startswith('data: '):
-                                data = line[6:].strip()
-                                
-                                if data == '[DONE]':
-                                    print(f"✅ [{request_id}] 流式响应完成，共处理 {chunk_count} 个原始chunk，{valid_chunk_count} 个有效chunk")
-                                    yield "data: [DONE]\n\n"
-                                    return
-                                elif data:
-                                    # 验证JSON格式
-                                    try:
-                                        json.loads(data)
-                                        valid_chunk_count += 1
-                                        # 每100个有效chunk打印一次进度
-                                        if valid_chunk_count % 100 == 0:
-                                            print(f"📡 [{request_id}] 已处理 {valid_chunk_count} 个有效chunk")
-                                        # 直接转发数据
-                                        yield f"data: {data}\n\n"
-                                    except json.JSONDecodeError:
-                                        # 如果JSON格式错误，记录日志但不转发
-                                        if chunk_count % 100 == 0:  # 减少错误日志频率
-                                            print(f"⚠️  [{request_id}] 跳过无效JSON数据 (第{chunk_count}个chunk)")
-                                        continue
+                        # 每100个有效chunk打印一次进度
+                        if valid_chunk_count % 100 == 0:
+                            print(f"📡 [{request_id}] 已处理 {valid_chunk_count} 个有效chunk")
+                        # 直接转发数据
+                        yield f"data: {data}\n\n"
+                        for event in completed_tool_call_events(completed_calls):
+                            yield event
                 
         except Exception as e:
             print(f"❌ [{request_id}] 流式请求异常: {str(e)}")
@@ -125,26 +330,7 @@ class DirectAgent:
         print(f"📝 [{request_id}] 消息数量: {len(messages)}")
         print(f"🔧 [{request_id}] 工具数量: {len(tools) if tools else 0}")
         
-        # 构建请求数据
-        request_data = {
-            "model": self.model_config["model"],
-            "messages": messages,
-            "stream": False,
-            "temperature": kwargs.get("temperature", 0.7),
-            "max_tokens": kwargs.get("max_tokens", 2000),
-        }
-        
-        # 如果有tools，也透传
-        if tools:
-            request_data["tools"] = tools
-            request_data["tool_choice"] = kwargs.get("tool_choice", "auto")
-            print(f"🔧 [{request_id}] 工具配置: {request_data['tool_choice']}")
-        
-        # 添加其他参数
-        for key, value in kwargs.items():
-            if key not in ["temperature", "max_tokens", "tool_choice"]:
-                request_data[key] = value
-                print(f"⚙️  [{request_id}] 额外参数: {key}={value}")
+        request_data = self._build_request_data(request_id, messages, tools, False, kwargs)
         
         # 打印最后一条用户消息（用于调试）
         if messages:
@@ -157,6 +343,14 @@ class DirectAgent:
             "Authorization": f"Bearer {self.model_config['api_key']}",
         }
         
+        # 查询语义缓存
+        cache_key = await self._semantic_cache_key(messages, tools, kwargs)
+        if cache_key:
+            cached = await self._semantic_cache_lookup(cache_key)
+            if cached is not None:
+                print(f"🎯 [{request_id}] 语义缓存命中，跳过上游请求")
+                return self._build_cached_completion(request_id, cached, stream=False)
+        
         print(f"🌐 [{request_id}] 发送请求到: {self.model_config['base_url']}/chat/completions")
         print(f"📊 [{request_id}] 请求参数: model={request_data['model']}, stream={request_data['stream']}")
         
@@ -180,6 +374,7 @@ class DirectAgent:
                 raise Exception(f"API请求失败: {response.status_code} - {response.text}")
             
             result = response.json()
+            self._record_cache_usage(request_id, result.get("usage"))
             
             # 打印响应摘要
             if "choices" in result and len(result["choices"]) > 0:
@@ -194,6 +389,10 @@ class DirectAgent:
                     print(f"🔧 [{request_id}] 工具调用数量: {len(tool_calls)}")
                     for i, tool_call in enumerate(tool_calls):
                         print(f"🔧 [{request_id}] 工具{i+1}: {tool_call.get('function', {}).get('name', 'unknown')}")
+                
+                # 仅缓存正常结束且不含工具调用的回答
+                if cache_key and choice.get("finish_reason") == "stop" and not choice.get("message", {}).get("tool_calls"):
+                    await self._semantic_cache_store(cache_key, choice.get("message", {}).get("content") or "")
             
             return result
             
@@ -201,6 +400,10 @@ class DirectAgent:
             print(f"❌ [{request_id}] 非流式请求异常: {str(e)}")
             raise e
     
+    def get_prompt_cache_stats(self):
+        """获取累计的前缀缓存命中统计"""
+        return self.prompt_cache_stats.to_dict()
+    
     def get_model_info(self):
         """获取模型信息"""
         return {
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+上游提示词前缀缓存支持
+
+DeepSeek、OpenAI 等会对与近期请求前缀相同的提示词给予折扣并加快首字响应。
+能否命中取决于客户端每轮发送的系统提示词、工具和历史消息是否一致，后端只原样透传；
+这里负责从 usage 中提取缓存命中的token数。
+"""
+
+from typing import Any, Dict, Optional
+
+# 支持 stream_options.include_usage 的提供商
+STREAM_USAGE_PROVIDERS = ("deepseek", "openai")
+
+
+def extract_cache_usage(usage: Optional[Dict]) -> Optional[Dict[str, int]]:
+    """从 usage 中提取提示词token数和缓存命中token数，不支持时返回 None"""
+    if not usage:
+        return None
+    cached_tokens = usage.get("prompt_cache_hit_tokens")  # DeepSeek
+    if cached_tokens is None:
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")  # OpenAI
+    if cached_tokens is None:
+        return None
+    return {
+        "prompt_tokens": usage.get("prompt_tokens") or 0,
+        "cached_tokens": cached_tokens or 0,
+    }
+
+
+class PromptCacheStats:
+    """累计的前缀缓存命中统计"""
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def record(self, cache_usage: Dict[str, int]):
+        self.requests += 1
+        self.prompt_tokens += cache_usage["prompt_tokens"]
+        self.cached_tokens += cache_usage["cached_tokens"]
+
+    def to_dict(self) -> Dict[str, Any]:
+        hit_rate = self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "hit_rate": round(hit_rate, 4),
+        }
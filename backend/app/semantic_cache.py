@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+语义响应缓存
+
+对最后一条用户消息做本地向量化，在同一作用域（模型、系统提示词、工具、历史消息）
+内检索相似度超过阈值的历史回答并直接返回，减少重复问题的上游请求。
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+from typing import Dict, List, Optional
+
+try:
+    import numpy as np
+except ImportError:  # 语义缓存为可选功能
+    np = None
+
+
+class _CacheEntry:
+    """缓存条目"""
+
+    __slots__ = ("scope", "query", "content", "created_at", "hits")
+
+    def __init__(self, scope: str, query: str, content: str):
+        self.scope = scope
+        self.query = query
+        self.content = content
+        self.created_at = time.time()
+        self.hits = 0
+
+
+class _ScopeIndex:
+    """单个作用域内的暴力检索索引（归一化向量矩阵 + 条目列表）"""
+
+    def __init__(self, dim: int):
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.entries: List[_CacheEntry] = []
+
+    def add(self, vector, entry: _CacheEntry):
+        self.vectors = np.vstack([self.vectors, vector[None, :]])
+        self.entries.append(entry)
+
+    def remove(self, positions: List[int]):
+        removed = set(positions)
+        keep = [i for i in range(len(self.entries)) if i not in removed]
+        self.vectors = self.vectors[keep]
+        self.entries = [self.entries[i] for i in keep]
+
+    def search(self, vector):
+        """返回 (相似度, 条目)，索引为空时返回 None"""
+        if not self.entries:
+            return None
+        scores = self.vectors @ vector
+        best = int(np.argmax(scores))
+        return float(scores[best]), self.entries[best]
+
+
+class SemanticCache:
+    """基于本地CPU向量模型和NumPy暴力检索的语义缓存"""
+
+    def __init__(self, model_name: str, threshold: float = 0.92,
+                 max_entries: int = 1000, ttl: int = 3600):
+        if np is None:
+            raise ImportError("语义缓存需要安装 numpy")
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError("语义缓存需要安装 sentence-transformers")
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.indexes: Dict[str, _ScopeIndex] = {}
+        self.size = 0
+        self.lock = asyncio.Lock()
+        print(f"✅ 语义缓存初始化完成: model={model_name}, threshold={threshold}, "
+              f"max_entries={max_entries}, ttl={ttl}s")
+
+    @staticmethod
+    def extract_query(messages: List[Dict]) -> Optional[str]:
+        """提取可缓存的查询文本，最后一条不是纯文本用户消息时返回 None"""
+        if not messages:
+            return None
+        last_message = messages[-1]
+        content = last_message.get("content")
+        if last_message.get("role") != "user" or not isinstance(content, str) or not content.strip():
+            return None
+        return content.strip()
+
+    @staticmethod
+    def build_scope(model: str, messages: List[Dict], tools: Optional[List[Dict]], params: Dict) -> str:
+        """根据模型、除最后一条外的全部消息、工具和采样参数计算作用域"""
+        scope_data = {
+            "model": model,
+            "history": messages[:-1],
+            "tools": tools or [],
+            "params": params,
+        }
+        raw = json.dumps(scope_data, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _encode(self, text: str):
+        vector = self.model.encode(text, normalize_embeddings=True)
+        return np.asarray(vector, dtype=np.float32)
+
+    async def embed(self, text: str):
+        """在线程池中计算归一化向量，避免阻塞事件循环"""
+        return await asyncio.to_thread(self._encode, text)
+
+    def _evict_expired(self):
+        now = time.time()
+        for scope, index in list(self.indexes.items()):
+            expired = [i for i, entry in enumerate(index.entries) if now - entry.created_at > self.ttl]
+            if expired:
+                index.remove(expired)
+                self.size -= len(expired)
+            if not index.entries:
+                del self.indexes[scope]
+
+    def _evict_least_used(self):
+        """容量已满时淘汰命中次数最少的条目，次数相同时淘汰最旧的"""
+        victim = None
+        for index in self.indexes.values():
+            for i, entry in enumerate(index.entries):
+                if victim is None or (entry.hits, entry.created_at) < (victim[2].hits, victim[2].created_at):
+                    victim = (index, i, entry)
+        if victim is None:
+            return
+        index, position, entry = victim
+        index.remove([position])
+        self.size -= 1
+        if not index.entries:
+            del self.indexes[entry.scope]
+
+    async def lookup(self, scope: str, vector) -> Optional[str]:
+        """查找语义相似的已缓存回答"""
+        async with self.lock:
+            self._evict_expired()
+            index = self.indexes.get(scope)
+            if index is None:
+                return None
+            found = index.search(vector)
+            if found is None:
+                return None
+            score, entry = found
+            if score < self.threshold:
+                return None
+            entry.hits += 1
+            print(f"🎯 语义缓存命中: score={score:.3f}, hits={entry.hits}, 原问题: {entry.query[:50]}")
+            return entry.content
+
+    async def store(self, scope: str, query: str, vector, content: str):
+        """写入缓存"""
+        if not content:
+            return
+        async with self.lock:
+            self._evict_expired()
+            while self.size > 0 and self.size >= self.max_entries:
+                self._evict_least_used()
+            index = self.indexes.get(scope)
+            if index is None:
+                index = self.indexes[scope] = _ScopeIndex(vector.shape[0])
+            index.add(vector, _CacheEntry(scope, query, content))
+            self.size += 1
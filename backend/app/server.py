@@ -3,7 +3,7 @@
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import json
 import asyncio
 import time
@@ -76,9 +76,29 @@ async def health_check():
         "version": "1.0.0",
         "agent_available": agent is not None,
         "provider": model_config["provider"],
-        "model": model_config["model"]
+        "model": model_config["model"],
+        "prompt_cache": agent.get_prompt_cache_stats() if agent else None
     }
 
+class RequestBodyTooLarge(Exception):
+    """请求体超过大小上限"""
+
+
+async def read_limited_body(request: Request, limit: int) -> bytes:
+    """读取请求体，超过limit字节时尽早中止"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > limit:
+        raise RequestBodyTooLarge(int(content_length))
+    
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise RequestBodyTooLarge(size)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
     """OpenAI兼容的聊天完成端点，完全透传"""
@@ -94,9 +114,15 @@ async def chat_completions(request: Request):
         return {"error": "Agent not initialized"}
     
     try:
-        # 获取请求数据
-        request_data = await request.json()
-        print(f"📦 [{request_id}] 请求数据大小: {len(json.dumps(request_data))} 字符")
+        # 获取请求数据：按上限读取原始字节，只解析一次
+        body = await read_limited_body(request, settings.MAX_REQUEST_BODY_SIZE)
+        print(f"📦 [{request_id}] 请求数据大小: {len(body)} 字节")
+        request_data = json.loads(body)
+        # 解析后立即释放原始字节，避免在等待上游响应期间仍占用内存
+        del body
+        if not isinstance(request_data, dict):
+            print(f"❌ [{request_id}] 请求体不是JSON对象")
+            return {"error": "Request body must be a JSON object"}
         
         # 提取基本参数
         messages = request_data.get("messages", [])
@@ -120,8 +146,9 @@ async def chat_completions(request: Request):
             print(f"💬 [{request_id}] 消息{i+1}: {role} - {content_preview}")
         
         # 提取其他参数（全部透传）
+        # on_tool_call / tool_call_events 是服务端内部参数，不允许从请求体传入
         other_params = {k: v for k, v in request_data.items() 
-                       if k not in ["messages", "stream", "tools"]}
+                       if k not in ["messages", "stream", "tools", "on_tool_call", "tool_call_events"]}
         
         if other_params:
             print(f"⚙️  [{request_id}] 其他参数: {other_params}")
@@ -129,12 +156,14 @@ async def chat_completions(request: Request):
         # 流式响应
         if stream:
             print(f"🌊 [{request_id}] 开始流式响应")
+            # 客户端可通过请求头开启组装好的工具调用事件
+            tool_call_events = request.headers.get("X-Tool-Call-Events", "").lower() in ("1", "true")
             
             async def stream_generator():
                 """流式数据生成器"""
                 try:
                     chunk_sent_count = 0
-                    async for chunk in agent.stream_chat(messages, tools, **other_params):
+                    async for chunk in agent.stream_chat(messages, tools, tool_call_events=tool_call_events, **other_params):
                         chunk_sent_count += 1
                         # 每100个chunk打印一次发送进度
                         if chunk_sent_count % 100 == 0:
@@ -168,7 +197,7 @@ async def chat_completions(request: Request):
                     "X-Request-ID": request_id,
                     "Access-Control-Allow-Origin": "*",
                     "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-                    "Access-Control-Allow-Headers": "Content-Type, Authorization"
+                    "Access-Control-Allow-Headers": "Content-Type, Authorization, X-Tool-Call-Events"
                 }
             )
         
@@ -179,6 +208,12 @@ async def chat_completions(request: Request):
         print(f"✅ [{request_id}] 请求处理完成")
         return result
         
+    except RequestBodyTooLarge as e:
+        print(f"❌ [{request_id}] 请求体过大: {e.args[0]} 字节，上限 {settings.MAX_REQUEST_BODY_SIZE} 字节")
+        return JSONResponse(
+            status_code=413,
+            content={"error": f"请求体过大，上限为 {settings.MAX_REQUEST_BODY_SIZE} 字节"}
+        )
     except json.JSONDecodeError as e:
         print(f"❌ [{request_id}] JSON解析错误: {str(e)}")
         return {"error": f"JSON解析失败: {str(e)}"}
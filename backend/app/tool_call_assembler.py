@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+流式工具调用组装器
+
+按 index 增量拼接流式响应中 delta.tool_calls 的参数片段（上游未返回 index 时按 id 区分调用），
+每个工具调用的参数一旦完整就立即产出，无需等待整轮响应结束。
+"""
+
+import json
+from typing import Dict, List, Optional
+
+
+class _PendingToolCall:
+    """组装中的工具调用，参数片段追加到列表，结束时一次性拼接"""
+
+    __slots__ = ("index", "id", "type", "name", "parts", "depth", "in_string", "escape", "done")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.id = None
+        self.type = "function"
+        self.name = ""
+        self.parts: List[str] = []
+        # 增量扫描JSON括号深度，避免每个片段都重新解析整个参数
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.done = False
+
+    def append(self, fragment: str) -> bool:
+        """追加参数片段，返回参数对象是否已闭合"""
+        self.parts.append(fragment)
+        closed = False
+        for char in fragment:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    closed = True
+        return closed
+
+    def to_dict(self) -> Dict:
+        return {
+            "index": self.index,
+            "id": self.id,
+            "type": self.type,
+            "function": {
+                "name": self.name,
+                "arguments": "".join(self.parts),
+            },
+        }
+
+
+class ToolCallAssembler:
+    """组装流式 tool_calls 片段"""
+
+    def __init__(self):
+        self.calls: Dict[int, _PendingToolCall] = {}
+        # 上游 index（缺失时为 None）到组装用 index 的映射
+        self.index_map: Dict[Optional[int], int] = {}
+
+    @property
+    def has_tool_calls(self) -> bool:
+        return bool(self.calls)
+
+    def _complete(self, call: _PendingToolCall) -> Dict:
+        call.done = True
+        return call.to_dict()
+
+    def _resolve_index(self, delta: Dict) -> int:
+        """确定片段所属的工具调用，id 变化时视为新的调用"""
+        key = delta.get("index")
+        index = self.index_map.get(key)
+        if index is not None:
+            call_id = delta.get("id")
+            if not call_id or not self.calls[index].id or call_id == self.calls[index].id:
+                return index
+        # 部分兼容接口不返回 index，每个并行调用单独一个 chunk，只能靠 id 区分
+        if key is not None and key not in self.calls:
+            index = key
+        else:
+            index = max(self.calls) + 1 if self.calls else 0
+        self.index_map[key] = index
+        return index
+
+    def feed(self, tool_call_deltas: List[Dict]) -> List[Dict]:
+        """处理一个 delta 中的 tool_calls 片段，返回本次已完整的工具调用"""
+        completed = []
+        for delta in tool_call_deltas:
+            index = self._resolve_index(delta)
+            call = self.calls.get(index)
+            if call is None:
+                # 工具调用按顺序流式输出，新的调用出现说明之前的调用已结束
+                for pending in self.calls.values():
+                    if pending.index < index and not pending.done:
+                        completed.append(self._complete(pending))
+                call = self.calls[index] = _PendingToolCall(index)
+
+            if delta.get("id"):
+                call.id = delta["id"]
+            if delta.get("type"):
+                call.type = delta["type"]
+            function = delta.get("function") or {}
+            if function.get("name"):
+                call.name += function["name"]
+            fragment = function.get("arguments")
+            if fragment and not call.done and call.append(fragment):
+                try:
+                    json.loads("".join(call.parts))
+                except json.JSONDecodeError:
+                    continue
+                completed.append(self._complete(call))
+        return completed
+
+    def finish(self) -> List[Dict]:
+        """响应结束时产出所有尚未完成的工具调用"""
+        return [self._complete(call) for call in self.calls.values() if not call.done]
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from app.tool_call_assembler import ToolCallAssembler
+
+
+def _delta(index=None, call_id=None, name=None, arguments=None):
+    delta = {}
+    if index is not None:
+        delta["index"] = index
+    if call_id is not None:
+        delta["id"] = call_id
+        delta["type"] = "function"
+    function = {}
+    if name is not None:
+        function["name"] = name
+    if arguments is not None:
+        function["arguments"] = arguments
+    if function:
+        delta["function"] = function
+    return delta
+
+
+def test_split_arguments_with_braces_and_escapes_in_strings():
+    assembler = ToolCallAssembler()
+    fragments = ['{"text": "a}', '\\"b{', '\\\\"', ', "n": [1, {"x": 2}]', "}"]
+
+    assert assembler.feed([_delta(0, "call_0", "echo", "")]) == []
+    completed = []
+    for fragment in fragments:
+        completed.extend(assembler.feed([_delta(0, arguments=fragment)]))
+
+    assert len(completed) == 1
+    assert completed[0]["id"] == "call_0"
+    assert completed[0]["function"]["name"] == "echo"
+    assert completed[0]["function"]["arguments"] == "".join(fragments)
+
+
+def test_new_index_closes_previous_call():
+    assembler = ToolCallAssembler()
+    assembler.feed([_delta(0, "call_0", "get_weather", '{"city": "北')])
+
+    completed = assembler.feed([_delta(1, "call_1", "get_time", "")])
+
+    assert [call["id"] for call in completed] == ["call_0"]
+    assert completed[0]["function"]["arguments"] == '{"city": "北'
+
+
+def test_finish_does_not_emit_completed_calls_again():
+    assembler = ToolCallAssembler()
+    completed = assembler.feed([_delta(0, "call_0", "get_weather", '{"city": "北京"}')])
+    completed += assembler.feed([_delta(1, "call_1", "get_time", '{"tz": ')])
+
+    assert [call["id"] for call in completed] == ["call_0"]
+    assert [call["id"] for call in assembler.finish()] == ["call_1"]
+    assert assembler.finish() == []
+
+
+def test_calls_without_index_are_split_by_id():
+    assembler = ToolCallAssembler()
+    completed = assembler.feed([_delta(call_id="c0", name="get_weather", arguments='{"city": ')])
+    completed += assembler.feed([_delta(arguments='"北京"')])
+    completed += assembler.feed([_delta(call_id="c1", name="get_time", arguments="{}")])
+    completed += assembler.finish()
+
+    assert [(call["index"], call["id"], call["function"]["name"]) for call in completed] == [
+        (0, "c0", "get_weather"),
+        (1, "c1", "get_time"),
+    ]
+    assert completed[0]["function"]["arguments"] == '{"city": "北京"'
+    assert completed[1]["function"]["arguments"] == "{}"